@@ -1,41 +1,133 @@
 import time
-import requests
-import json # Import the json library
+import httpx
+import orjson # Fast JSON encoding/decoding for API responses and the seen offers file
+from pybloom_live import ScalableBloomFilter # Bounded-memory membership test for seen offers
+import hashlib # For fingerprinting response bodies
+import io
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime # For HTTP-date Retry-After values
 import logging
 import random
+import itertools
+import bisect # For the sector image lookup
+from collections import namedtuple
 import os # For environment variables
 import asyncio # Import asyncio
 import re # Import regular expressions
-from telegram import Bot
-from telegram.error import TelegramError # Correct import for error handling
+import signal # For a clean shutdown on SIGTERM
 
 # --- Configuration ---
 # URL of the API endpoint to check
 # IMPORTANT: Replace {some_id_I_have} with the actual ID if it's static,
 # or ensure your environment provides it if it's dynamic. The {event_id} placeholder
-# will be replaced by each ID from the EVENT_IDS list.
+# will be replaced by each ID from the EVENTS list.
 API_URL_TEMPLATE = "https://availability.ticketmaster.es/api/v2/TM_ES/resale/{event_id}"  # <<< VERIFY THIS TEMPLATE
-# List of Event IDs to check. You can add as many IDs as you need.
-EVENT_IDS = ["417009905","1848567714", "1589736692", "961888291", "1852247887", "1341715816", "412370092", "2035589996", "1378879656", "1566404077"] # <<< ADD YOUR EVENT IDS HERE
-# Corresponding dates for each Event ID. MUST match the order and count of EVENT_IDS.
-EVENT_DATES = ['30/05/26', '31/05/26', '02/06/26', '03/06/26', '06/06/26', '07/06/26', '10/06/26', '11/06/26', '14/06/26', '15/06/26'] # <<< DATES CORRESPONDING TO EVENT_IDS
+# Public event page, linked from notifications and sent as the Referer
+EVENT_LINK_TEMPLATE = "https://www.ticketmaster.es/event/{event_id}"
+# (id, date, api_url, link) record per event; URLs are formatted once here instead of every tick
+Event = namedtuple('Event', 'id date api_url link')
+
+def make_event(event_id, event_date):
+    """Builds an Event from its ID and date, filling in its API URL and public page link."""
+    return Event(event_id, event_date, API_URL_TEMPLATE.format(event_id=event_id), EVENT_LINK_TEMPLATE.format(event_id=event_id))
+
+# Events to check, each ID paired with its date. You can add as many as you need.
+EVENTS = ( # <<< ADD YOUR EVENT IDS AND DATES HERE
+    make_event("417009905", '30/05/26'),
+    make_event("1848567714", '31/05/26'),
+    make_event("1589736692", '02/06/26'),
+    make_event("961888291", '03/06/26'),
+    make_event("1852247887", '06/06/26'),
+    make_event("1341715816", '07/06/26'),
+    make_event("412370092", '10/06/26'),
+    make_event("2035589996", '11/06/26'),
+    make_event("1378879656", '14/06/26'),
+    make_event("1566404077", '15/06/26'),
+)
 # The JSON structure representing an "empty" response (no data)
 EMPTY_RESPONSE = {"groups": [], "offers": []}  # <<< ADJUST IF THE EMPTY RESPONSE IS DIFFERENT
+# Raw encodings of EMPTY_RESPONSE the server may send (compact or spaced, either key order), matched before parsing
+EMPTY_BODY_CANDIDATES = frozenset({
+    orjson.dumps(EMPTY_RESPONSE),
+    b'{"groups":[],"offers":[]}',
+    b'{"offers":[],"groups":[]}',
+    b'{"groups": [], "offers": []}',
+    b'{"offers": [], "groups": []}',
+})
+# Longest of those; anything longer can't be empty, so it skips hashing the whole body for the set lookup
+EMPTY_BODY_MAX_LENGTH = max(map(len, EMPTY_BODY_CANDIDATES))
 # How often to check the API, in seconds
 CHECK_INTERVAL_SECONDS = 45  # <<< YOU CAN CHANGE THIS
 # Minimum and maximum delay (in seconds) to add *before* each request
 MIN_DELAY = 2
 MAX_DELAY = 9
+# How long idle pooled connections are kept; longer than a full tick so they are reused across polls
+HTTP_KEEPALIVE_EXPIRY_SECONDS = CHECK_INTERVAL_SECONDS + MAX_DELAY + 15
+# Most API requests allowed in flight at once, including their retries; the rest wait for a free slot
+MAX_CONCURRENT_API_REQUESTS = 4
+# Retry policy for transient API failures (rate limiting, server errors, network errors).
+# Waits API_RETRY_BACKOFF_FACTOR * 2**attempt seconds, or the server's Retry-After if given.
+API_MAX_RETRIES = 5
+API_RETRY_BACKOFF_FACTOR = 1.0
+API_MAX_RETRY_DELAY = 60
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# Statuses meaning this event is forbidden or geoblocked for us; it is skipped for the rest of the run
+BLOCKED_STATUS_CODES = frozenset({403, 451})
 # Maximum price for an offer to be considered for notification
 MAX_PRICE_THRESHOLD = 250.00 # <<< SET YOUR DESIRED MAX PRICE HERE
 SOURCES_DIR = "/app/sources" # Directory for images (pista.jpg, golden.jpg, 100.jpg, etc.)
+# Telegram rejects messages longer than this; batched notifications are split to stay under it
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+# Separator between offers combined into a single Telegram message
+NOTIFICATION_SEPARATOR = "\n\n"
 # Telegram Configuration (to be set via environment variables)
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Telegram Bot API endpoint; calls go over the same pooled HTTP session as the API checks
+TELEGRAM_API_BASE_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
 # TELEGRAM_CHAT_IDS should be a comma-separated string of chat IDs, e.g., "123456789,987654321"
 TELEGRAM_CHAT_IDS_STR = os.getenv("TELEGRAM_CHAT_IDS") 
-# Path inside the container where the seen offers data will be stored.
-SEEN_OFFERS_FILE_PATH = "/app/data/seen_offers.json" # Ensure /app/data is a mounted volume in Docker
-seen_offer_ids = set()
+# Paths inside the container where the seen offers data will be stored. Ensure /app/data is a mounted volume in Docker.
+# Snapshot of the seen offers Bloom filter
+SEEN_OFFERS_BLOOM_PATH = "/app/data/seen_offers.bloom"
+# Append-only log of offer IDs seen since the last snapshot, one JSON value per line.
+# Adding an offer costs one short append instead of rewriting the whole snapshot.
+SEEN_OFFERS_LOG_PATH = "/app/data/seen_offers.log"
+# JSON list written by earlier versions; imported once when no Bloom snapshot exists yet
+SEEN_OFFERS_FILE_PATH = "/app/data/seen_offers.json"
+# Once the log holds this many entries it is folded into the snapshot and truncated
+SEEN_OFFERS_COMPACT_THRESHOLD = 1000
+# Bloom filter sizing: a false positive only means one offer is silently not notified
+SEEN_OFFERS_INITIAL_CAPACITY = 100_000
+SEEN_OFFERS_ERROR_RATE = 1e-4
+# ETags and body fingerprints of the last processed responses, so a restart keeps skipping unchanged events
+RESPONSE_CACHE_PATH = "/app/data/response_cache.json"
+
+def new_seen_offers_filter():
+    """Creates an empty seen offers Bloom filter with the configured sizing."""
+    return ScalableBloomFilter(initial_capacity=SEEN_OFFERS_INITIAL_CAPACITY, error_rate=SEEN_OFFERS_ERROR_RATE)
+
+# Offer IDs already notified. A Bloom filter instead of a set (~80 bytes per ID), since the bot runs
+# for weeks and only ever needs "have we sent this one?". The first slice is preallocated for
+# SEEN_OFFERS_INITIAL_CAPACITY IDs (~240 KB, also the snapshot size) and more are added only beyond that.
+seen_offer_ids = new_seen_offers_filter()
+_seen_log_file = None # Binary append handle to SEEN_OFFERS_LOG_PATH, opened on first use
+_seen_log_entries = 0 # Entries currently in the log
+# Event IDs that answered with a BLOCKED_STATUS_CODES status; not polled again until restart
+BLOCKED_EVENT_IDS = set()
+# (host, HTTP version) pairs already logged by log_http_version
+_negotiated_http_versions = set()
+# Per-event cache of the last processed response: {event_id: {'etag': ..., 'hash': ...}}
+_response_cache = {}
+_saved_response_cache = None # Serialized form last written to RESPONSE_CACHE_PATH
+_api_request_slots = None # Semaphore of MAX_CONCURRENT_API_REQUESTS, created on first use so it binds to the running event loop
+
+# Headers identical on every request, set once on the session. No Connection header: HTTP/2 forbids it.
+BASE_HEADERS = {
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Origin': 'https://www.ticketmaster.es',
+    'DNT': '1', # Do Not Track header, common in browsers
+}
 
 # List of possible User-Agent strings to rotate through
 USER_AGENTS = [
@@ -44,364 +136,801 @@ USER_AGENTS = [
     'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.107 Safari/537.36',
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0'
 ]
+# Round-robin over the User-Agents in an order shuffled once at startup: every agent is used
+# equally often and picking one costs a next() instead of an RNG call per request.
+_UA_CYCLE = itertools.cycle(random.sample(USER_AGENTS, len(USER_AGENTS)))
 
-# Configure logging
-logging.basicConfig(level=logging.INFO,
+# Configure logging. Set LOG_LEVEL=WARNING in production to drop the per-offer INFO chatter.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
                     format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+# HTTP client loggers print every request URL at INFO, and Telegram URLs carry the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
 
 # --- Seen Offers Functions ---
+def import_legacy_seen_offers():
+    """Adds the IDs from an earlier version's seen_offers.json list to seen_offer_ids."""
+    try:
+        with open(SEEN_OFFERS_FILE_PATH, 'rb') as f:
+            loaded_ids = orjson.loads(f.read())
+        if isinstance(loaded_ids, list):
+            for offer_id in loaded_ids:
+                seen_offer_ids.add(offer_id)
+            logger.info("Imported %s seen offer IDs from %s", len(loaded_ids), SEEN_OFFERS_FILE_PATH)
+        else:
+            logger.warning("Content of %s is not a list. Nothing imported.", SEEN_OFFERS_FILE_PATH)
+    except orjson.JSONDecodeError:
+        logger.error("Error decoding JSON from %s. Nothing imported.", SEEN_OFFERS_FILE_PATH)
+
 def load_seen_offers():
-    global seen_offer_ids
+    """Loads the seen offers Bloom snapshot, then replays the append-only log written since it was taken."""
+    global seen_offer_ids, _seen_log_entries
     try:
-        if os.path.exists(SEEN_OFFERS_FILE_PATH):
-            with open(SEEN_OFFERS_FILE_PATH, 'r') as f:
-                loaded_ids = json.load(f)
-                if isinstance(loaded_ids, list):
-                    seen_offer_ids = set(loaded_ids)
-                    logging.info(f"Loaded {len(seen_offer_ids)} seen offer IDs from {SEEN_OFFERS_FILE_PATH}")
-                else:
-                    logging.warning(f"Content of {SEEN_OFFERS_FILE_PATH} is not a list. Starting with empty set.")
-                    seen_offer_ids = set()
+        if os.path.exists(SEEN_OFFERS_BLOOM_PATH):
+            with open(SEEN_OFFERS_BLOOM_PATH, 'rb') as f:
+                seen_offer_ids = ScalableBloomFilter.fromfile(f)
+            logger.info("Loaded %s seen offer IDs from %s", len(seen_offer_ids), SEEN_OFFERS_BLOOM_PATH)
         else:
-            logging.info(f"{SEEN_OFFERS_FILE_PATH} not found. Starting with empty set of seen offers.")
-            seen_offer_ids = set()
-    except json.JSONDecodeError:
-        logging.error(f"Error decoding JSON from {SEEN_OFFERS_FILE_PATH}. Starting with empty set.")
-        seen_offer_ids = set()
+            seen_offer_ids = new_seen_offers_filter()
+            if os.path.exists(SEEN_OFFERS_FILE_PATH):
+                import_legacy_seen_offers()
+                save_seen_offers() # Snapshot right away so the legacy list is only imported once
+            else:
+                logger.info("%s not found. Starting with empty set of seen offers.", SEEN_OFFERS_BLOOM_PATH)
+    except Exception as e:
+        logger.error("Error loading %s: %s. Starting with empty set.", SEEN_OFFERS_BLOOM_PATH, e)
+        seen_offer_ids = new_seen_offers_filter()
+    try:
+        _seen_log_entries = replay_seen_offers_log()
+    except Exception as e:
+        logger.error("Error replaying %s: %s", SEEN_OFFERS_LOG_PATH, e)
+
+def replay_seen_offers_log():
+    """Adds the IDs recorded in the append-only log to seen_offer_ids; returns how many entries it held."""
+    if not os.path.exists(SEEN_OFFERS_LOG_PATH):
+        return 0
+    entries = 0
+    with open(SEEN_OFFERS_LOG_PATH, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                seen_offer_ids.add(orjson.loads(line))
+                entries += 1
+            except orjson.JSONDecodeError: # A crash mid-append can leave a partial last line
+                logger.warning("Skipping malformed line in %s: %r", SEEN_OFFERS_LOG_PATH, line[:100])
+    logger.info("Replayed %s seen offer IDs from %s", entries, SEEN_OFFERS_LOG_PATH)
+    return entries
+
+def write_file_atomically(path, data, durable=False):
+    """
+    Writes bytes to path via a temporary file, so a crash mid-write never leaves a truncated file behind.
+    With durable=True the data is fsynced before the swap, so a power loss can't leave an empty file either.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True) # Create the directory if it doesn't exist
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def serialize_seen_offers():
+    """Returns the seen_offer_ids Bloom snapshot as bytes."""
+    buffer = io.BytesIO()
+    seen_offer_ids.tofile(buffer)
+    return buffer.getvalue()
+
+def save_seen_offers(snapshot=None):
+    """Writes the full seen_offer_ids Bloom snapshot (or a given serialized one). Returns True on success."""
+    try:
+        # Only the snapshot is fsynced: the log is truncated after it, so it must really be on disk.
+        # Log appends skip fsync to keep notifications from stalling on the disk.
+        write_file_atomically(SEEN_OFFERS_BLOOM_PATH, serialize_seen_offers() if snapshot is None else snapshot, durable=True)
+        return True
+    except Exception as e:
+        logger.error("Error saving %s: %s", SEEN_OFFERS_BLOOM_PATH, e)
+        return False
+
+async def compact_seen_offers():
+    """Folds the append-only log into the snapshot, then empties the log."""
+    global _seen_log_entries
+    # Serialize on the event loop so the filter can't change mid-copy; only the disk write goes to a thread
+    if not await asyncio.to_thread(save_seen_offers, serialize_seen_offers()):
+        return # Keep the log; it still holds the only durable copy of the recent IDs
+    try:
+        if _seen_log_file is not None:
+            _seen_log_file.seek(0)
+            _seen_log_file.truncate()
+        elif os.path.exists(SEEN_OFFERS_LOG_PATH):
+            open(SEEN_OFFERS_LOG_PATH, 'wb').close()
+        _seen_log_entries = 0
+        logger.info("Compacted seen offers into %s (%s IDs)", SEEN_OFFERS_BLOOM_PATH, len(seen_offer_ids))
     except Exception as e:
-        logging.error(f"Error loading {SEEN_OFFERS_FILE_PATH}: {e}. Starting with empty set.")
-        seen_offer_ids = set()
+        logger.error("Error truncating %s: %s", SEEN_OFFERS_LOG_PATH, e)
 
-def save_seen_offers():
-    global seen_offer_ids
+def add_seen_offer(offer_id):
+    """Marks an offer as notified, appending it to the log so it survives a restart."""
+    global _seen_log_file, _seen_log_entries
+    if offer_id in seen_offer_ids:
+        return
+    seen_offer_ids.add(offer_id)
     try:
-        directory = os.path.dirname(SEEN_OFFERS_FILE_PATH)
-        if not os.path.exists(directory):
-            os.makedirs(directory) # Create the directory if it doesn't exist
-        with open(SEEN_OFFERS_FILE_PATH, 'w') as f:
-            json.dump(list(seen_offer_ids), f, indent=2) # Save as a list for readability
+        if _seen_log_file is None:
+            os.makedirs(os.path.dirname(SEEN_OFFERS_LOG_PATH), exist_ok=True)
+            _seen_log_file = open(SEEN_OFFERS_LOG_PATH, 'ab')
+        _seen_log_file.write(orjson.dumps(offer_id) + b"\n") # JSON keeps the ID's type across restarts; buffered until flush_seen_offers_log()
+        _seen_log_entries += 1
     except Exception as e:
-        logging.error(f"Error saving {SEEN_OFFERS_FILE_PATH}: {e}")
+        logger.error("Error appending to %s: %s", SEEN_OFFERS_LOG_PATH, e)
+
+def flush_seen_offers_log():
+    """Writes the buffered log appends to disk, so a tick's new offers cost one write instead of one per offer."""
+    if _seen_log_file is None:
+        return
+    try:
+        _seen_log_file.flush()
+    except Exception as e:
+        logger.error("Error flushing %s: %s", SEEN_OFFERS_LOG_PATH, e)
+
+# --- Response Cache Persistence ---
+def response_filter_fingerprint():
+    """
+    Hashes the settings that decide which offers get sent and how (price threshold, available images).
+    Cached responses were skipped under these settings, so they're only reusable while it matches.
+    Call after load_offer_images().
+    """
+    settings = orjson.dumps([MAX_PRICE_THRESHOLD, _pista_image_path, _golden_image_path, _sector_image_paths])
+    return hashlib.blake2b(settings, digest_size=8).hexdigest()
+
+def load_response_cache():
+    """Restores the per-event ETags and body fingerprints saved by a previous run under the same filter settings."""
+    global _saved_response_cache
+    if not os.path.exists(RESPONSE_CACHE_PATH):
+        return
+    try:
+        with open(RESPONSE_CACHE_PATH, 'rb') as f:
+            raw = f.read()
+        saved = orjson.loads(raw)
+        if saved.get('filter') != response_filter_fingerprint():
+            logger.info("Filter settings changed since %s was written; re-evaluating every event.", RESPONSE_CACHE_PATH)
+            return
+        for event_id, entry in saved['events'].items():
+            _response_cache[event_id] = {'etag': entry.get('etag'), 'hash': bytes.fromhex(entry['hash']) if entry.get('hash') else None}
+        _saved_response_cache = raw
+        logger.info("Loaded cached responses for %s events from %s", len(_response_cache), RESPONSE_CACHE_PATH)
+    except Exception as e:
+        logger.error("Error loading %s: %s. Starting with an empty response cache.", RESPONSE_CACHE_PATH, e)
+        _response_cache.clear()
+
+async def save_response_cache():
+    """Writes the response cache in a worker thread, skipping the write when nothing changed since the last save."""
+    global _saved_response_cache
+    raw = orjson.dumps({
+        'filter': response_filter_fingerprint(),
+        'events': {event_id: {'etag': entry['etag'], 'hash': entry['hash'].hex() if entry['hash'] else None}
+                   for event_id, entry in _response_cache.items()},
+    })
+    if raw == _saved_response_cache:
+        return
+    try:
+        await asyncio.to_thread(write_file_atomically, RESPONSE_CACHE_PATH, raw)
+        _saved_response_cache = raw
+    except Exception as e:
+        logger.error("Error saving %s: %s", RESPONSE_CACHE_PATH, e)
+
+# --- Offer Parsing Patterns ---
+# Sector identifier inside a place key such as "M-217": the first digit and what follows it
+SECTOR_RE = re.compile(r'\d[\d\w-]*')
+# Leading number of a sector, matched against the numbered sector images
+DIGITS_RE = re.compile(r'\d+')
+
+# --- Offer Images ---
+# Filled once by load_offer_images(); the image set is fixed for the container's lifetime
+_pista_image_path = None # SOURCES_DIR/pista.jpg if it exists
+_golden_image_path = None # SOURCES_DIR/golden.jpg if it exists
+_sector_image_numbers = [] # Sorted numbers of the numbered sector images, e.g. [100, 200, 300]
+_sector_image_paths = [] # Path for each entry in _sector_image_numbers
+_photo_bytes_cache = {} # Image path -> file contents, read on first send and reused for every chat after
+
+def load_offer_images():
+    """Scans SOURCES_DIR once for the pista, golden and numbered sector images."""
+    global _pista_image_path, _golden_image_path, _sector_image_numbers, _sector_image_paths
+    pista_image_path = os.path.join(SOURCES_DIR, "pista.jpg")
+    golden_image_path = os.path.join(SOURCES_DIR, "golden.jpg")
+    _pista_image_path = pista_image_path if os.path.exists(pista_image_path) else None
+    _golden_image_path = golden_image_path if os.path.exists(golden_image_path) else None
+    if _pista_image_path is None:
+        logger.warning("%s not found.", pista_image_path)
+    if _golden_image_path is None:
+        logger.warning("%s not found.", golden_image_path)
+    sector_images = {}
+    if os.path.isdir(SOURCES_DIR):
+        for filename in os.listdir(SOURCES_DIR):
+            base_name = filename[:-4]
+            if filename.lower().endswith(".jpg") and base_name.isdigit():
+                sector_images.setdefault(int(base_name), os.path.join(SOURCES_DIR, filename))
+    _sector_image_numbers = sorted(sector_images)
+    _sector_image_paths = [sector_images[number] for number in _sector_image_numbers]
+    logger.info("Found %s sector images in %s", len(_sector_image_numbers), SOURCES_DIR)
+
+def find_sector_image(sector_value):
+    """Returns the image with the highest number <= sector_value, or None if there is none."""
+    index = bisect.bisect_right(_sector_image_numbers, sector_value) - 1
+    return _sector_image_paths[index] if index >= 0 else None
+
+def read_file_bytes(path):
+    """Returns the full contents of a file."""
+    with open(path, 'rb') as f:
+        return f.read()
+
+async def get_photo_bytes(photo_path):
+    """Returns the contents of an image, reading it from disk (in a worker thread) only the first time. None if it can't be read."""
+    photo_bytes = _photo_bytes_cache.get(photo_path)
+    if photo_bytes is None:
+        try:
+            photo_bytes = _photo_bytes_cache[photo_path] = await asyncio.to_thread(read_file_bytes, photo_path)
+        except OSError:
+            return None
+    return photo_bytes
+
+# --- Offer Message Template ---
+# Bold offer type, date hyperlinked to the event page, blank line, seat info lines, blank line, bold price.
+# Bound once so formatting an offer doesn't re-resolve the template; arguments must already be escaped.
+_format_offer_message = "*{0}* [{1}]({2})\n\n{3}\n*{4}€*".format
 
 # --- MarkdownV2 Escaping Function ---
+# Maps every MarkdownV2 special character, plus the backslash itself, to its escaped form.
+# str.translate applies it in one C-level pass, with no Python loop or regex per call.
+MARKDOWN_V2_ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '_*[]()~`>#+-=|{}.!\\'})
+
 def escape_markdown_v2(text):
     """Escapes special characters for Telegram MarkdownV2."""
-    if not isinstance(text, str): # Ensure text is a string
-        text = str(text)
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    return ''.join(['\\' + char if char in escape_chars else char for char in text])
+    return str(text).translate(MARKDOWN_V2_ESCAPE_TABLE) # str() ensures text is a string
+
+# --- Rate Limiting ---
+class TokenBucket:
+    """
+    Async token bucket: acquire() waits until a token is available. Tokens refill at `rate`
+    per second up to `burst`. pause() blocks every acquirer until a server-given deadline.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = None # Created on first use so it binds to the running event loop
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock: # Waiters queue up in order instead of racing for refilled tokens
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# Telegram's limits: about 30 messages per second overall, one per second into a single chat,
+# and 20 per minute into a group. Every send waits on the global bucket and its chat's buckets.
+TELEGRAM_BUCKET = TokenBucket(rate=30.0, burst=30)
+TELEGRAM_CHAT_RATE_PER_SECOND = 1.0
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_GROUP_RATE_PER_MINUTE = 20
+# Attempts per message when Telegram answers with flood control (retry_after)
+TELEGRAM_MAX_SEND_ATTEMPTS = 3
+_telegram_chat_buckets = {} # Chat ID -> tuple of that chat's TokenBuckets
+
+def get_telegram_chat_buckets(chat_id):
+    """Returns the buckets a send to chat_id must wait on: a per-chat one, plus a per-group one for group chats (negative IDs)."""
+    buckets = _telegram_chat_buckets.get(chat_id)
+    if buckets is None:
+        buckets = (TokenBucket(rate=TELEGRAM_CHAT_RATE_PER_SECOND, burst=TELEGRAM_CHAT_BURST),)
+        if str(chat_id).startswith('-'):
+            buckets += (TokenBucket(rate=TELEGRAM_GROUP_RATE_PER_MINUTE / 60, burst=TELEGRAM_GROUP_RATE_PER_MINUTE),)
+        _telegram_chat_buckets[chat_id] = buckets
+    return buckets
 
 # --- Telegram Function ---
-async def send_telegram_message_to_single_chat(bot_instance, chat_id, message_text, photo_path=None):
+class TelegramAPIError(Exception):
+    """Raised when the Telegram Bot API answers a call with ok=false."""
+    def __init__(self, message, error_code=None, parameters=None):
+        super().__init__(message)
+        self.message = message
+        self.error_code = error_code
+        self.parameters = parameters or {}
+
+async def call_telegram_api(session, method, **request_kwargs):
+    """POSTs to a Telegram Bot API method over the shared session and returns the call's 'result'."""
+    response = await session.post(f"{TELEGRAM_API_BASE_URL}/{method}", timeout=15, **request_kwargs)
+    payload = orjson.loads(response.content)
+    if not payload.get('ok'):
+        raise TelegramAPIError(payload.get('description', f"HTTP {response.status_code}"), payload.get('error_code'), payload.get('parameters'))
+    return payload['result']
+
+async def send_telegram_message_to_single_chat(session, chat_id, message_text, photo_path=None):
     """Sends a message (text or photo with caption) via Telegram to a single chat_id."""
-    if not bot_instance or not chat_id:
-        logging.error("Telegram bot or chat_id not configured. Cannot send message.")
+    if not session or not chat_id:
+        logger.error("Telegram session or chat_id not configured. Cannot send message.")
         return False # Indicate failure
-    try:
-        if photo_path and os.path.exists(photo_path):
-            with open(photo_path, 'rb') as photo_file:
-                sent_message = await bot_instance.send_photo(
-                    chat_id=chat_id,
-                    photo=photo_file,
-                    caption=message_text,
-                    parse_mode='MarkdownV2'
+    chat_buckets = get_telegram_chat_buckets(chat_id)
+    for attempt in range(TELEGRAM_MAX_SEND_ATTEMPTS):
+        try:
+            for bucket in chat_buckets:
+                await bucket.acquire()
+            await TELEGRAM_BUCKET.acquire()
+            photo_bytes = await get_photo_bytes(photo_path) if photo_path else None
+            if photo_bytes is not None:
+                sent_message = await call_telegram_api(
+                    session, 'sendPhoto',
+                    data={'chat_id': str(chat_id), 'caption': message_text, 'parse_mode': 'MarkdownV2'},
+                    files={'photo': (os.path.basename(photo_path), photo_bytes, 'image/jpeg')},
                 )
-            logging.info(f"Telegram API ACKNOWLEDGED sending PHOTO to Chat ID: {chat_id}. Message ID: {sent_message.message_id}, Caption: \"{sent_message.caption[:50].replace(chr(10), ' ')}...\"")
-        else:
-            if photo_path: # photo_path was given but file not found
-                 logging.warning(f"Photo path {photo_path} provided but file not found. Sending text message instead.")
-            sent_message = await bot_instance.send_message(chat_id=chat_id, text=message_text, parse_mode='MarkdownV2')
-            logging.info(f"Telegram API ACKNOWLEDGED sending TEXT message to Chat ID: {chat_id}. Message ID: {sent_message.message_id}, Text: \"{sent_message.text[:50].replace(chr(10), ' ')}...\"")
-        return True # Indicate success
-    except TelegramError as e: # Specific Telegram error
-        logging.error(f"TelegramError sending message to {chat_id}: {e.message}")
-        # Check for common errors like bot blocked or chat not found
-        error_str = str(e).lower()
-        if "bot was blocked by the user" in error_str or "chat not found" in error_str:
-            logging.warning(f"Bot may have been blocked or chat ID {chat_id} is invalid.")
-        elif "group chat was upgraded to a supergroup chat" in error_str:
-            logging.warning(f"Group chat {chat_id} was upgraded. New chat ID might be needed: {e.message}")
-    except Exception as e: # Catch other potential errors during sending
-        logging.error(f"Unexpected error sending Telegram message to {chat_id}: {e}")
+                logger.info("Telegram API ACKNOWLEDGED sending PHOTO to Chat ID: %s. Message ID: %s, Caption: \"%s...\"", chat_id, sent_message['message_id'], sent_message.get('caption', '')[:50].replace(chr(10), ' '))
+            else:
+                if photo_path: # photo_path was given but file not found
+                     logger.warning("Photo path %s provided but file not found. Sending text message instead.", photo_path)
+                sent_message = await call_telegram_api(
+                    session, 'sendMessage',
+                    content=orjson.dumps({'chat_id': chat_id, 'text': message_text, 'parse_mode': 'MarkdownV2'}),
+                    headers={'Content-Type': 'application/json'},
+                )
+                logger.info("Telegram API ACKNOWLEDGED sending TEXT message to Chat ID: %s. Message ID: %s, Text: \"%s...\"", chat_id, sent_message['message_id'], sent_message.get('text', '')[:50].replace(chr(10), ' '))
+            return True # Indicate success
+        except TelegramAPIError as e: # Error reported by the Bot API
+            logger.error("TelegramAPIError sending message to %s: %s", chat_id, e.message)
+            retry_after = e.parameters.get('retry_after')
+            if retry_after: # Flood control: hold every send until Telegram accepts messages again, then retry this one
+                logger.warning("Telegram rate limit hit; pausing sends for %ss (attempt %s/%s).", retry_after, attempt + 1, TELEGRAM_MAX_SEND_ATTEMPTS)
+                TELEGRAM_BUCKET.pause(retry_after)
+                for bucket in chat_buckets:
+                    bucket.pause(retry_after)
+                continue
+            # Check for common errors like bot blocked or chat not found
+            error_str = str(e).lower()
+            if "bot was blocked by the user" in error_str or "chat not found" in error_str:
+                logger.warning("Bot may have been blocked or chat ID %s is invalid.", chat_id)
+            elif "group chat was upgraded to a supergroup chat" in error_str:
+                logger.warning("Group chat %s was upgraded. New chat ID might be needed: %s", chat_id, e.message)
+        except Exception as e: # Catch other potential errors during sending
+            logger.error("Unexpected error sending Telegram message to %s: %s", chat_id, e)
+        break # Only flood control is worth retrying
     return False # Indicate failure
 
+def batch_text_notifications(notifications, max_length=TELEGRAM_MAX_MESSAGE_LENGTH):
+    """Groups text notifications into batches whose joined text fits in a single Telegram message."""
+    batches = []
+    current_batch = []
+    current_length = 0
+    for notification in notifications:
+        added_length = len(notification['text']) + (len(NOTIFICATION_SEPARATOR) if current_batch else 0)
+        if current_batch and current_length + added_length > max_length:
+            batches.append(current_batch)
+            current_batch = []
+            current_length = 0
+            added_length = len(notification['text'])
+        current_batch.append(notification)
+        current_length += added_length
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+async def send_notifications(session, telegram_chat_ids, notifications):
+    """
+    Sends one tick's notifications to every chat ID.
+    Offers with an image go out as individual photos (captions can't be merged);
+    text-only offers are combined into as few messages as the length limit allows.
+    """
+    deliveries = [([notification], notification['text'], notification['photo_path'])
+                  for notification in notifications if notification['photo_path']]
+    for batch in batch_text_notifications([notification for notification in notifications if not notification['photo_path']]):
+        deliveries.append((batch, NOTIFICATION_SEPARATOR.join(notification['text'] for notification in batch), None))
+
+    # Deliveries run concurrently within the Telegram rate limits; each offer is a self-contained message,
+    # so arrival order isn't guaranteed (a small text can overtake a photo upload or a flood-control retry)
+    results = await asyncio.gather(*(deliver_to_chats(session, telegram_chat_ids, message_text, photo_path)
+                                     for _, message_text, photo_path in deliveries), return_exceptions=True)
+    for (batch, _, _), any_message_sent_successfully in zip(deliveries, results):
+        if isinstance(any_message_sent_successfully, Exception):
+            logger.error("Unexpected error delivering notification: %s", any_message_sent_successfully)
+            any_message_sent_successfully = False
+        for notification in batch:
+            if any_message_sent_successfully and notification['offer_id']: # Only add to seen if sent to at least one
+                add_seen_offer(notification['offer_id'])
+            elif not any_message_sent_successfully:
+                _response_cache.pop(notification['event_id'], None) # Forget this response so the offer is retried next tick
+    await asyncio.to_thread(flush_seen_offers_log) # No offers are added while this runs, so the buffer isn't shared
+    if _seen_log_entries >= SEEN_OFFERS_COMPACT_THRESHOLD:
+        await compact_seen_offers()
+
+async def deliver_to_chats(session, telegram_chat_ids, message_text, photo_path=None):
+    """Sends one message to every chat ID. Returns True if at least one chat received it."""
+    # Chats are sent to concurrently; their buckets bound the rate, not the order messages arrive in
+    results = await asyncio.gather(*(send_telegram_message_to_single_chat(session, chat_id_to_send_to, message_text, photo_path=photo_path)
+                                     for chat_id_to_send_to in telegram_chat_ids), return_exceptions=True)
+    return any(result is True for result in results)
+
+# --- HTTP Session ---
+def get_proxy_url():
+    """Builds the proxy URL from environment variables, or returns None when no proxy is configured."""
+    # --- Proxy Integration ---
+    # Replace with your Decodo proxy address and port.
+    # Consider moving this to environment variables as well.
+    proxy_host = os.getenv("PROXY_HOST")
+    proxy_port = os.getenv("PROXY_PORT")
+    proxy_user = os.getenv("PROXY_USER") # If your proxy requires authentication
+    proxy_pass = os.getenv("PROXY_PASS")
+
+    if proxy_host and proxy_port:
+        proxy_url = f"http://{proxy_user}:{proxy_pass}@{proxy_host}:{proxy_port}" if proxy_user and proxy_pass else f"http://{proxy_host}:{proxy_port}"
+        logger.info("Using proxy: %s", proxy_url)
+        return proxy_url
+    logger.warning("Proxy not configured. Requests will be made without a proxy.")
+    return None
+
+def make_session(proxy_url=None):
+    """
+    Builds a pooled httpx.AsyncClient with HTTP/2 enabled, so all event checks multiplex
+    over a single TLS connection. Only Ticketmaster traffic is routed through the proxy.
+    """
+    # httpx drops idle connections after 5s by default, which would mean a fresh TLS handshake every tick
+    limits = httpx.Limits(max_keepalive_connections=4, max_connections=10, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS)
+    mounts = {}
+    if proxy_url:
+        mounts["https://availability.ticketmaster.es"] = httpx.AsyncHTTPTransport(http2=True, limits=limits, proxy=proxy_url)
+    return httpx.AsyncClient(
+        http2=True,
+        limits=limits,
+        mounts=mounts,
+        timeout=30.0,
+        headers=BASE_HEADERS,
+    )
+
+def get_api_request_slots():
+    """Returns the semaphore bounding concurrent API requests."""
+    global _api_request_slots
+    if _api_request_slots is None:
+        _api_request_slots = asyncio.Semaphore(MAX_CONCURRENT_API_REQUESTS)
+    return _api_request_slots
+
+def log_http_version(response):
+    """Logs the negotiated HTTP version the first time it is seen for a host, to confirm HTTP/2 is in use."""
+    key = (response.url.host, response.http_version)
+    if key not in _negotiated_http_versions:
+        _negotiated_http_versions.add(key)
+        logger.info("Negotiated %s with %s", response.http_version, response.url.host)
+
+def get_retry_delay(response, attempt):
+    """Seconds to wait before retry number `attempt`, honoring a Retry-After header when present."""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), API_MAX_RETRY_DELAY)
+    return min(API_RETRY_BACKOFF_FACTOR * (2 ** attempt), API_MAX_RETRY_DELAY)
+
+async def get_with_retries(session, url, headers):
+    """GETs `url`, retrying RETRY_STATUS_CODES responses and network errors with exponential backoff."""
+    for attempt in range(API_MAX_RETRIES + 1):
+        response = None
+        try:
+            response = await session.get(url, headers=headers)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == API_MAX_RETRIES:
+                return response
+        except httpx.TransportError as e:
+            if attempt == API_MAX_RETRIES:
+                raise
+            logger.warning("Network error fetching %s: %s", url, e)
+        delay = get_retry_delay(response, attempt)
+        status = response.status_code if response is not None else "network error"
+        logger.warning("Retrying %s in %.1fs after %s (attempt %s/%s)", url, delay, status, attempt + 1, API_MAX_RETRIES)
+        await asyncio.sleep(delay)
+
 # --- API Check Function ---
-async def check_api_for_event(bot_instance, telegram_chat_id_to_send, event_id, event_date_str):
+def process_offer(offer, groups_by_offer_id, event_id, event_date_str, event_link):
     """
-    Fetches data from the API endpoint for a specific event_id,
+    Filters one offer (price threshold, already seen) and formats its notification.
+    Returns the notification dict, or None if the offer shouldn't be sent.
+    """
+    # Cheapest filter first: the price check is two dict lookups, the seen check hashes the ID several times
+    total_price_raw = (offer.get('price') or {}).get('total')
+    if not isinstance(total_price_raw, (int, float)):
+        logger.warning("No valid price/total found for offer in event %s (%r). Skipping message for this offer.", event_id, total_price_raw)
+        return None # Skip this offer
+    calculated_price_val = total_price_raw / 100
+    # Price condition check using the defined threshold
+    if calculated_price_val >= MAX_PRICE_THRESHOLD:
+        logger.info("Offer price %.2f for event %s is >= %.2f. Skipping message.", calculated_price_val, event_id, MAX_PRICE_THRESHOLD)
+        return None # Skip this offer
+
+    # --- Check if offer has already been seen ---
+    current_offer_id = offer.get('id') # This is the unique ID for the offer (not 'listingId'); groups reference it too
+    if current_offer_id and current_offer_id in seen_offer_ids:
+        logger.info("Offer ID %s for event %s already seen. Skipping notification.", current_offer_id, event_id)
+        return None # Skip this offer
+
+    # Only offers that passed both filters get their strings built
+    offer_type_description = offer.get('offerTypeDescription', 'N/A')
+    calculated_price_str = f"{calculated_price_val:.2f}"
+
+    # --- Extract Seat Information ---
+    # Lines are escaped for MarkdownV2 as they're built; the raw sector is kept for the image lookup
+    seat_info_lines = []
+    sector = None
+    group = groups_by_offer_id.get(current_offer_id) if current_offer_id else None
+
+    places = group.get('places') if group else None
+    if places:
+        # Only the first place and its first row are shown, as per example
+        place_key, row_data = next(iter(places.items())) # e.g., place_key = "M-217"
+        # Extract sector: find the first digit and everything after that looks like part of an identifier
+        match = SECTOR_RE.search(place_key)
+        sector = match.group(0) if match else place_key # Fallback to full key if no numeric part found
+        seat_info_lines.append(f"SECTOR: {escape_markdown_v2(sector)}\n")
+        if isinstance(row_data, dict) and row_data:
+            row_num_str, seat_list = next(iter(row_data.items())) # e.g., row_number = "4"
+            seat_info_lines.append(f"FILA: {escape_markdown_v2(row_num_str)}\n")
+            if isinstance(seat_list, list) and seat_list:
+                # Join multiple seats if present
+                seat_info_lines.append(f"ASIENTO: {escape_markdown_v2(', '.join(seat_list))}\n")
+
+    # Escape dynamic content for MarkdownV2
+    escaped_offer_type = escape_markdown_v2(offer_type_description)
+    escaped_date = escape_markdown_v2(event_date_str)
+    escaped_price = escape_markdown_v2(calculated_price_str)
+
+    # --- Determine Image to Send ---
+    image_to_send_path = None
+    offer_desc_lower = offer_type_description.lower()
+
+    # 1. Pista/Gold Check
+    if 'pista' in offer_desc_lower or 'floor' in offer_desc_lower:
+        image_to_send_path = _pista_image_path
+    elif 'gold' in offer_desc_lower or 'golden' in offer_desc_lower:
+        image_to_send_path = _golden_image_path
+
+    # 2. Sector Check (if no Pista/Gold match and sector info is available)
+    if not image_to_send_path and sector is not None:
+        sector_digits_match = DIGITS_RE.search(sector)
+        extracted_sector_value_for_image = int(sector_digits_match.group(0)) if sector_digits_match else None
+
+        if extracted_sector_value_for_image is not None:
+            image_to_send_path = find_sector_image(extracted_sector_value_for_image)
+            if not image_to_send_path:
+                logger.info("No suitable sector image (<= value) found for sector %s in %s", extracted_sector_value_for_image, SOURCES_DIR)
+        else:
+            logger.info("No Pista/Gold image match, and sector value not determined from seat info for image lookup.")
+
+    # Construct the message from the pre-bound template; each seat line carries its own newline
+    message_to_send = _format_offer_message(escaped_offer_type, escaped_date, event_link, "".join(seat_info_lines), escaped_price)
+
+    # Queue the notification; they are all sent together at the end of the tick
+    return {
+        'event_id': event_id,
+        'offer_id': current_offer_id,
+        'text': message_to_send,
+        'photo_path': image_to_send_path,
+    }
+
+async def check_api_for_event(session, event_id, event_date_str, current_api_url, event_link, initial_delay=0):
+    """
+    Waits out this event's slot in the tick's schedule (initial_delay),
+    fetches data from the API endpoint for a specific event_id,
     parses the JSON response,
-    and sends specific offer details via Telegram if found.
+    and returns the Telegram notifications to send for any new matching offers.
     """
-    current_api_url = API_URL_TEMPLATE.format(event_id=event_id)
+    notifications = []
+    if initial_delay:
+        await asyncio.sleep(initial_delay)
     try:
-        # Construct a plausible referer URL to make the request look more legitimate
-        referer_url = f"https://www.ticketmaster.es/event/{event_id}"
+        # Static headers live on the session; only rotate the per-call ones here.
+        # The event page doubles as a plausible referer to make the request look more legitimate.
         headers = {
-            'User-Agent': random.choice(USER_AGENTS),
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Connection': 'keep-alive',
-            'Referer': referer_url,
-            'Origin': 'https://www.ticketmaster.es',
-            'DNT': '1', # Do Not Track header, common in browsers
+            'User-Agent': next(_UA_CYCLE),
+            'Referer': event_link,
         }
 
-        # --- Proxy Integration ---
-        # Replace with your Decodo proxy address and port.
-        # Consider moving this to environment variables as well.
-        proxy_host = os.getenv("PROXY_HOST")
-        proxy_port = os.getenv("PROXY_PORT")
-        proxy_user = os.getenv("PROXY_USER") # If your proxy requires authentication
-        proxy_pass = os.getenv("PROXY_PASS")
-
-        if proxy_host and proxy_port:
-            proxies = {
-                "http": f"http://{proxy_user}:{proxy_pass}@{proxy_host}:{proxy_port}" if proxy_user and proxy_pass else f"http://{proxy_host}:{proxy_port}",
-                "https": f"http://{proxy_user}:{proxy_pass}@{proxy_host}:{proxy_port}" if proxy_user and proxy_pass else f"http://{proxy_host}:{proxy_port}",
-            }
-            logging.info(f"Using proxy: {proxies}")
-        else:
-            proxies = None
-            logging.warning("Proxy not configured. Requests will be made without a proxy.")
+        # Conditional GET: let the server answer 304 Not Modified if nothing changed since the last poll
+        cached = _response_cache.get(event_id, {})
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
 
-        # requests.get is a blocking call. In a fully async app, you'd use aiohttp or run this in an executor.        
-        response = requests.get(current_api_url, headers=headers, timeout=30, proxies=proxies)
+        async with get_api_request_slots(): # Only the request is bounded, so the staggered waits still overlap
+            response = await get_with_retries(session, current_api_url, headers)
+        log_http_version(response)
+        if response.status_code == 304: # Not Modified, nothing new to notify
+            return notifications
+        if response.status_code in BLOCKED_STATUS_CODES:
+            BLOCKED_EVENT_IDS.add(event_id)
+            logger.warning("Received %s for event ID %s (date %s). IP may be blocked or geoblocked; skipping this event until restart. Ensure your proxy is working correctly or consider rotating proxies.", response.status_code, event_id, event_date_str)
+            return notifications
         response.raise_for_status()
+        raw_body = response.content
+        etag = response.headers.get('ETag')
+
+        # Fast path for the steady state: an empty body needs neither hashing nor parsing
+        if len(raw_body) <= EMPTY_BODY_MAX_LENGTH and raw_body in EMPTY_BODY_CANDIDATES:
+            _response_cache[event_id] = {'etag': etag, 'hash': None} # Keep the ETag so the next poll can get a 304
+            return notifications
+
+        # Servers without ETag support still send identical bodies; skip them by fingerprint
+        body_hash = hashlib.blake2b(raw_body, digest_size=16).digest()
+        if body_hash == cached.get('hash'):
+            return notifications
 
         try:
-            data = response.json()
-        except json.JSONDecodeError:
-            logging.error(f"Failed to decode JSON response from {current_api_url}")
-            logging.error(f"Response text: {response.text[:500]}...")
-            return
+            data = orjson.loads(raw_body)
+        except orjson.JSONDecodeError:
+            logger.error("Failed to decode JSON response from %s", current_api_url)
+            logger.error("Response text: %s...", raw_body[:500])
+            return notifications
 
-        if data != EMPTY_RESPONSE:
-            offers_data = data.get('offers')
-            if isinstance(offers_data, list) and offers_data:
-                for i, offer in enumerate(offers_data):
-                    offer_type_description = offer.get('offerTypeDescription', 'N/A')
-                    calculated_price_str = "N/A"
-                    price_info = offer.get('price')
-                    if price_info and 'total' in price_info:
-                        try:
-                            total_price_raw = price_info['total']
-                            if isinstance(total_price_raw, (int, float)):
-                                calculated_price_val = total_price_raw / 100
-                                # Price condition check using the defined threshold
-                                if calculated_price_val < MAX_PRICE_THRESHOLD:
-                                    calculated_price_str = f"{calculated_price_val:.2f}"
-                                else:
-                                    logging.info(f"Offer price {calculated_price_val:.2f} for event {event_id} is >= 400.00. Skipping message.")
-                                    continue # Skip to the next offer
-                            else:
-                                calculated_price_str = f"Invalid format ({total_price_raw})"
-                                logging.warning(f"Price format invalid for offer in event {event_id}. Skipping message for this offer.")
-                                continue # Skip to the next offer
-                        except (ValueError, TypeError, KeyError) as e:
-                            calculated_price_str = f"Error processing"
-                            logging.error(f"Error processing price for offer in event {event_id}: {e}. Skipping message for this offer.")
-                            continue # Skip to the next offer
-                    else: # No price info or total
-                        logging.warning(f"No price/total found for offer in event {event_id}. Skipping message for this offer.")
-                        continue # Skip to the next offer
-                    
-                    # --- Check if offer has already been seen ---
-                    current_offer_id = offer.get('id') # This is the unique ID for the offer
-                    if current_offer_id and current_offer_id in seen_offer_ids:
-                        logging.info(f"Offer ID {current_offer_id} for event {event_id} already seen. Skipping notification.")
-                        continue # Skip to the next offer
-
-                    # --- Extract Seat Information ---
-                    seat_info_lines = []
-                    offer_id_to_match = offer.get('id') # Use the 'id' from the offer, not 'listingId'
-                    groups_data = data.get('groups', [])
-                    
-                    if offer_id_to_match:
-                        for group in groups_data:
-                            if offer_id_to_match in group.get('offerIds', []): # Match offer 'id' with 'offerIds' in group
-                                places = group.get('places', {})
-                                if places:
-                                    # Assuming one place entry per matching group for simplicity, as per example
-                                    for place_key, row_data in places.items(): # e.g., place_key = "M-217"
-                                        # Extract sector: find the first digit and everything after that looks like part of an identifier
-                                        match = re.search(r'\d[\d\w-]*', place_key)
-                                        sector = match.group(0) if match else place_key # Fallback to full key if no numeric part found
-                                        seat_info_lines.append(f"SECTOR: {sector}")
-                                        if isinstance(row_data, dict):
-                                            for row_num_str, seat_list in row_data.items(): # e.g., row_number = "4"
-                                                seat_info_lines.append(f"FILA: {row_num_str}")
-                                                if isinstance(seat_list, list) and seat_list:
-                                                    # Join multiple seats if present, or take the first
-                                                    raw_asientos_str = ", ".join(seat_list) # Not escaped here
-                                                    seat_info_lines.append(f"ASIENTO: {raw_asientos_str}")
-                                                break # Assuming one row per place for this offer
-                                        break # Assuming one place structure per group for this offer
-                                break # Found matching group
-
-                    # Escape dynamic content for MarkdownV2
-                    escaped_offer_type = escape_markdown_v2(offer_type_description)
-                    escaped_date = escape_markdown_v2(event_date_str)
-                    escaped_price = escape_markdown_v2(calculated_price_str)
-                    event_link = f"https://www.ticketmaster.es/event/{event_id}"
-
-                    # --- Determine Image to Send ---
-                    image_to_send_path = None
-                    offer_desc_lower = offer_type_description.lower()
-
-                    # 1. Pista/Gold Check
-                    if 'pista' in offer_desc_lower or 'floor' in offer_desc_lower:
-                        pista_image_path = os.path.join(SOURCES_DIR, "pista.jpg")
-                        if os.path.exists(pista_image_path):
-                            image_to_send_path = pista_image_path
-                        else:
-                            logging.warning(f"{pista_image_path} not found.")
-                    elif 'gold' in offer_desc_lower or 'golden' in offer_desc_lower:
-                        golden_image_path = os.path.join(SOURCES_DIR, "golden.jpg")
-                        if os.path.exists(golden_image_path):
-                            image_to_send_path = golden_image_path
-                        else:
-                            logging.warning(f"{golden_image_path} not found.")
-
-                    # 2. Sector Check (if no Pista/Gold match and sector info is available)
-                    if not image_to_send_path and seat_info_lines:
-                        extracted_sector_value_for_image = None
-                        for line in seat_info_lines: # seat_info_lines contains raw, unescaped strings here
-                            if line.startswith("SECTOR:"):
-                                try:
-                                    sector_part_str = line.split(":", 1)[1].strip()
-                                    sector_digits_match = re.search(r'\d+', sector_part_str)
-                                    if sector_digits_match:
-                                        extracted_sector_value_for_image = int(sector_digits_match.group(0))
-                                        break 
-                                except (IndexError, ValueError) as e_parse:
-                                    logging.warning(f"Could not parse sector for image from line '{line}': {e_parse}")
-                        
-                        if extracted_sector_value_for_image is not None:
-                            candidate_image_numbers = []
-                            if os.path.exists(SOURCES_DIR) and os.path.isdir(SOURCES_DIR):
-                                for filename in os.listdir(SOURCES_DIR):
-                                    if filename.lower().endswith(".jpg"):
-                                        base_name = filename[:-4] 
-                                        if base_name.isdigit():
-                                            img_num = int(base_name)
-                                            if img_num <= extracted_sector_value_for_image:
-                                                candidate_image_numbers.append(img_num)
-                            if candidate_image_numbers:
-                                best_match_num = max(candidate_image_numbers)
-                                potential_image_path = os.path.join(SOURCES_DIR, f"{best_match_num}.jpg")
-                                if os.path.exists(potential_image_path):
-                                    image_to_send_path = potential_image_path
-                                else:
-                                    logging.warning(f"Constructed sector image path {potential_image_path} does not exist.")
-                            else:
-                                logging.info(f"No suitable sector image (<= value) found for sector {extracted_sector_value_for_image} in {SOURCES_DIR}")
-                        else:
-                            logging.info(f"No Pista/Gold image match, and sector value not determined from seat_info for image lookup.")
-
-                    # Construct the message header
-                    header_line = f"*{escaped_offer_type}* [{escaped_date}]({event_link})" # Date as hyperlink
-
-                    message_lines = [
-                        header_line,
-                        "" # Blank line
-                    ]
-
-                    if seat_info_lines:
-                        message_lines.extend([escape_markdown_v2(line) for line in seat_info_lines]) # Escape each seat info line
-                    
-                    message_lines.append("") # Blank line
-                    message_lines.append(f"*{escaped_price}€*")
-
-                    message_to_send = "\n".join(message_lines)
-                    
-                    # Send to all configured chat IDs
-                    any_message_sent_successfully = False
-                    for chat_id_to_send_to in telegram_chat_id_to_send: # telegram_chat_id_to_send is now a list
-                        if await send_telegram_message_to_single_chat(bot_instance, chat_id_to_send_to, message_to_send, photo_path=image_to_send_path):
-                            any_message_sent_successfully = True
-                    if any_message_sent_successfully and current_offer_id: # Only add to seen if sent to at least one
-                        seen_offer_ids.add(current_offer_id)
-                        save_seen_offers() # Save the updated list
-                    
-                    if len(offers_data) > 1 and i < len(offers_data) - 1:
-                        await asyncio.sleep(1) # Use asyncio.sleep
-            elif data != EMPTY_RESPONSE:
-                logging.warning(f"Data found for event ID {event_id} (linked to date {event_date_str}), but no 'offers' array or it's empty. Raw data structure: {json.dumps(data)}")
-    except requests.exceptions.HTTPError as http_err: # Catch HTTP errors (like 403) specifically
-        logging.error(f"HTTP error fetching {current_api_url}: {http_err}")
-        if http_err.response.status_code == 403: # Check for 403 Forbidden
-            logging.warning(f"Received 403 Forbidden. IP may be blocked. Ensure your proxy is working correctly or consider rotating proxies.")
-    except requests.exceptions.RequestException as req_err: # Broader request exceptions (network issues, etc.)
-        logging.error(f"Request error fetching {current_api_url}: {req_err}")
-        logging.error(f"This was for event ID {event_id} (linked to date {event_date_str}).")
+        offers_data = data.get('offers') or ()
+        groups_data = data.get('groups') or ()
+        if not offers_data and not groups_data: # Empty in a form EMPTY_BODY_CANDIDATES didn't catch; nothing to report
+            _response_cache[event_id] = {'etag': etag, 'hash': body_hash}
+            return notifications
+        offer_failed = False
+        if isinstance(offers_data, list) and offers_data:
+            # Index groups by offer ID once, instead of scanning every group for every offer.
+            # setdefault keeps the first matching group, like the scan did.
+            groups_by_offer_id = {}
+            for group in groups_data:
+                for group_offer_id in group.get('offerIds', []):
+                    groups_by_offer_id.setdefault(group_offer_id, group)
+            for offer in offers_data:
+                try:
+                    notification = process_offer(offer, groups_by_offer_id, event_id, event_date_str, event_link)
+                except Exception as e: # One malformed offer must not drop the rest of the response
+                    logger.error("Error processing an offer for event ID %s (date %s): %s", event_id, event_date_str, e)
+                    offer_failed = True
+                    continue
+                if notification:
+                    notifications.append(notification)
+        else:
+            if logger.isEnabledFor(logging.WARNING): # Avoid serializing the payload when the warning would be dropped
+                logger.warning("Data found for event ID %s (linked to date %s), but no 'offers' array or it's empty. Raw data structure: %s", event_id, event_date_str, orjson.dumps(data)[:1000].decode(errors='replace'))
+        # Cached only once every offer was processed cleanly, so a failed one is retried next tick
+        if not offer_failed:
+            _response_cache[event_id] = {'etag': etag, 'hash': body_hash}
+    except httpx.HTTPStatusError as http_err: # Catch HTTP errors (like 404 or exhausted retries) specifically
+        logger.error("HTTP error fetching %s: %s", current_api_url, http_err)
+    except httpx.HTTPError as req_err: # Broader request exceptions (network issues, timeouts, etc.)
+        logger.error("Request error fetching %s: %s", current_api_url, req_err)
+        logger.error("This was for event ID %s (linked to date %s).", event_id, event_date_str)
     except Exception as e:
-        logging.error(f"An unexpected error occurred while processing event ID {event_id} (date {event_date_str}): {e}")
+        logger.error("An unexpected error occurred while processing event ID %s (date %s): %s", event_id, event_date_str, e)
+    return notifications
+
+def stagger_delays(count):
+    """
+    Builds one tick's pre-request delays: the MIN_DELAY..MAX_DELAY window is split into
+    `count` equal slots, each event gets a random slot and a random point inside it.
+    Requests stay spread out like a human browsing, but the whole tick fits in one window.
+    """
+    slot_width = (MAX_DELAY - MIN_DELAY) / count if count else 0
+    slots = random.sample(range(count), count)
+    return [MIN_DELAY + (slot + random.random()) * slot_width for slot in slots]
+
+async def check_all_events(session, telegram_chat_ids_list):
+    """Checks every configured event concurrently, then sends everything found during the tick in one batch."""
+    events = [event for event in EVENTS if event.id not in BLOCKED_EVENT_IDS]
+    delays = stagger_delays(len(events))
+    results = await asyncio.gather(*[
+        check_api_for_event(session, *event, initial_delay=delay)
+        for delay, event in zip(delays, events)
+    ], return_exceptions=True) # One failing event must not discard the notifications found for the others
+    notifications = []
+    for event, event_notifications in zip(events, results):
+        if isinstance(event_notifications, Exception):
+            logger.error("Checking event ID %s (date %s) failed: %s", event.id, event.date, event_notifications)
+            continue
+        notifications.extend(event_notifications)
+    if notifications:
+        await send_notifications(session, telegram_chat_ids_list, notifications)
+    await save_response_cache() # After sending, so responses whose offers failed to go out are not persisted
 
 # --- Main Async Function ---
 async def main():
-    logging.info("Starting API checker script...")
+    logger.info("Starting API checker script...")
 
     if not TELEGRAM_BOT_TOKEN:
-        logging.error("CRITICAL: TELEGRAM_BOT_TOKEN environment variable not set. Exiting.")
+        logger.error("CRITICAL: TELEGRAM_BOT_TOKEN environment variable not set. Exiting.")
         exit(1)
     if not TELEGRAM_CHAT_IDS_STR:
-        logging.error("CRITICAL: TELEGRAM_CHAT_IDS environment variable not set. Exiting.")
+        logger.error("CRITICAL: TELEGRAM_CHAT_IDS environment variable not set. Exiting.")
         exit(1)
     
     # Parse the comma-separated chat IDs into a list
     telegram_chat_ids_list = [chat_id.strip() for chat_id in TELEGRAM_CHAT_IDS_STR.split(',') if chat_id.strip()]
     if not telegram_chat_ids_list:
-        logging.error("CRITICAL: TELEGRAM_CHAT_IDS environment variable is set but contains no valid chat IDs after parsing. Exiting.")
-        exit(1)
-    logging.info(f"Target Telegram Chat IDs: {telegram_chat_ids_list}")
-
-    if not EVENT_IDS or any(id_val in ["YOUR_EVENT_ID_1", "YOUR_EVENT_ID_2", "YOUR_EVENT_ID_3"] for id_val in EVENT_IDS):
-        logging.warning("Please update the EVENT_IDS list with your actual event IDs.")
-    logging.info(f"API URL Template: {API_URL_TEMPLATE}")
-    if len(EVENT_IDS) != len(EVENT_DATES):
-        logging.error("CRITICAL: The number of items in EVENT_IDS and EVENT_DATES does not match!")
-        logging.error(f"EVENT_IDS has {len(EVENT_IDS)} items, EVENT_DATES has {len(EVENT_DATES)} items.")
-        logging.error("Please ensure both lists have the same number of entries and correspond to each other. Exiting.")
+        logger.error("CRITICAL: TELEGRAM_CHAT_IDS environment variable is set but contains no valid chat IDs after parsing. Exiting.")
         exit(1)
-    logging.info(f"Event IDs to check: {EVENT_IDS}")
-    logging.info(f"Looking for data different from: {json.dumps(EMPTY_RESPONSE)}")
-
-    # Load seen offers at startup
-    load_seen_offers()
-
-    bot_instance = Bot(token=TELEGRAM_BOT_TOKEN)
-    logging.info("Telegram Bot initialized.")
-
-    # --- TEST MESSAGE ON STARTUP & LOG CREDENTIALS ---
-    # Log the first few and last few characters of the token to verify it's loaded, but not the whole thing for security.
-    token_preview = f"{TELEGRAM_BOT_TOKEN[:5]}...{TELEGRAM_BOT_TOKEN[-5:]}" if TELEGRAM_BOT_TOKEN and len(TELEGRAM_BOT_TOKEN) > 10 else "Token not loaded or too short"    
-    logging.info(f"Script using Token (preview): {token_preview}")
-    test_message_text = f"*Fan2Fan Bot Startup Test* `(async)`\nIf you see this, basic Telegram sending is working\nBot instance active: `{bot_instance is not None}`"
-    logging.info(f"Attempting to send startup test message to: {telegram_chat_ids_list}")
-    for chat_id_to_test in telegram_chat_ids_list:
-        if await send_telegram_message_to_single_chat(bot_instance, chat_id_to_test, test_message_text):
-            logging.info(f"Startup test message sent successfully to {chat_id_to_test}.")
-    # --- END OF TEST MESSAGE ---
-
-    while True:
+    logger.info("Target Telegram Chat IDs: %s", telegram_chat_ids_list)
+
+    event_ids = [event.id for event in EVENTS]
+    if not event_ids or any(id_val in ["YOUR_EVENT_ID_1", "YOUR_EVENT_ID_2", "YOUR_EVENT_ID_3"] for id_val in event_ids):
+        logger.warning("Please update the EVENTS list with your actual event IDs.")
+    logger.info("API URL Template: %s", API_URL_TEMPLATE)
+    logger.info("Event IDs to check: %s", event_ids)
+    logger.info("Looking for data different from: %s", orjson.dumps(EMPTY_RESPONSE).decode())
+
+    # Load seen offers, images and cached responses in a worker thread; the Bloom snapshot can be large
+    await asyncio.to_thread(load_seen_offers)
+    await asyncio.to_thread(load_offer_images) # Before the response cache, whose validity depends on the images found
+    await asyncio.to_thread(load_response_cache)
+
+    async with make_session(get_proxy_url()) as session:
+        logger.info("HTTP session initialized.")
+
+        # --- TEST MESSAGE ON STARTUP & LOG CREDENTIALS ---
+        # Log the first few and last few characters of the token to verify it's loaded, but not the whole thing for security.
+        token_preview = f"{TELEGRAM_BOT_TOKEN[:5]}...{TELEGRAM_BOT_TOKEN[-5:]}" if TELEGRAM_BOT_TOKEN and len(TELEGRAM_BOT_TOKEN) > 10 else "Token not loaded or too short"    
+        logger.info("Script using Token (preview): %s", token_preview)
+        test_message_text = f"*Fan2Fan Bot Startup Test* `(async)`\nIf you see this, basic Telegram sending is working\nHTTP session active: `{not session.is_closed}`"
+        logger.info("Attempting to send startup test message to: %s", telegram_chat_ids_list)
+        for chat_id_to_test in telegram_chat_ids_list:
+            if await send_telegram_message_to_single_chat(session, chat_id_to_test, test_message_text):
+                logger.info("Startup test message sent successfully to %s.", chat_id_to_test)
+        # --- END OF TEST MESSAGE ---
+
+        # docker stop sends SIGTERM, Ctrl-C sends SIGINT; both become a cancellation so the shutdown compaction below runs
+        main_task = asyncio.current_task()
+        def request_shutdown(signum):
+            logger.info("Received %s. Exiting...", signal.Signals(signum).name)
+            main_task.cancel()
         try:
-            if not EVENT_IDS:
-                logging.warning("EVENT_IDS list is empty. Nothing to check. Sleeping for interval.")
-            else:
-                for index, event_id in enumerate(EVENT_IDS):
-                    event_date_str = EVENT_DATES[index]
-                    random_request_delay = random.uniform(MIN_DELAY, MAX_DELAY)
-                    await asyncio.sleep(random_request_delay) # Use asyncio.sleep
-                    await check_api_for_event(bot_instance, telegram_chat_ids_list, event_id, event_date_str) # Pass the list of chat IDs
-            await asyncio.sleep(CHECK_INTERVAL_SECONDS) # Use asyncio.sleep
-        except KeyboardInterrupt:
-            logging.info("Script interrupted by user. Exiting...")
-            break
-        except Exception as e:
-            logging.error(f"An error occurred in the main loop: {e}")
-            logging.info(f"Waiting for {CHECK_INTERVAL_SECONDS} seconds before retrying...")
-            await asyncio.sleep(CHECK_INTERVAL_SECONDS) # Use asyncio.sleep
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                asyncio.get_running_loop().add_signal_handler(signum, request_shutdown, signum)
+        except NotImplementedError: # Signal handlers aren't supported by the Windows event loop
+            pass
+        try:
+            while True:
+                tick_start = time.monotonic()
+                try:
+                    if not EVENTS:
+                        logger.warning("EVENTS list is empty. Nothing to check. Sleeping for interval.")
+                    else:
+                        await check_all_events(session, telegram_chat_ids_list) # Pass the list of chat IDs
+                except Exception as e:
+                    logger.error("An error occurred in the main loop: %s", e)
+                # Fixed-rate schedule: the interval is measured from the start of the tick,
+                # so time spent checking and notifying doesn't push every later tick back.
+                sleep_for = CHECK_INTERVAL_SECONDS - (time.monotonic() - tick_start)
+                if sleep_for > 0:
+                    await asyncio.sleep(sleep_for) # Use asyncio.sleep
+                else:
+                    logger.warning("Tick ran long by %.1fs; starting the next one immediately.", -sleep_for)
+        except asyncio.CancelledError:
+            logger.info("Cancelled; shutting down.")
+        finally:
+            if _seen_log_entries: # Fold the log into the snapshot so the next start has nothing to replay
+                logger.info("Shutting down; compacting seen offers.")
+                await compact_seen_offers()
 
 # --- Entry Point ---
 if __name__ == "__main__":
+    try:
+        import uvloop # libuv-based event loop with lower per-task and timer overhead
+        uvloop.install()
+    except ImportError: # Not available on Windows; the stdlib loop works the same, just slower
+        pass
     asyncio.run(main())